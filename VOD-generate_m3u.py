@@ -1,11 +1,19 @@
 import os
-import urllib.request
+import functools
 import json
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import urlparse
+import urllib3
 from unidecode import unidecode
 
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib encoder
+    orjson = None
+
 # Configuration
 M3U_PERMANENT_DIR = "m3u_permanent"
 SOURCES = [
@@ -23,11 +31,31 @@ SOURCE_GROUPS = {
 FINAL_M3U = "master.m3u"
 METADATA_JSON = "video_metadata.json"
 DOWNLOAD_TIMEOUT = 15
+MAX_WORKERS = 8
+SUPPORTED_EXTENSIONS = frozenset({'.mp4', '.mkv'})  # add '.m3u8' to keep HLS sources
 DEFAULT_LOGO = "https://raw.githubusercontent.com/bugsfreeweb/LiveTVCollector/main/BugsfreeLogo/default-logo.png"
 
 # Setup logging
 logging.basicConfig(filename='generate.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Sources overlap heavily, so the same non-ASCII titles recur across fetches
+_transliterate = functools.lru_cache(maxsize=4096)(unidecode)
+
+_LOGO_RE = re.compile(r'tvg-logo\s*=\s*"([^"]+)"')
+# One scan over the playlist: an #EXTGRP line, or an #EXTINF line plus the line after it
+_ENTRY_RE = re.compile(r'^#EXT(?:GRP([^\r\n]*)|INF([^\r\n]*)(?:\r?\n([^\r\n]*))?)', re.MULTILINE)
+
+# Shared connection pool so sources on the same host reuse TCP/TLS connections
+HEADERS = {'User-Agent': 'Mozilla/5.0'}
+# Retry-After is ignored because urllib3 would sleep for it uncapped, and one long value
+# would outlast the workflow's 10-minute timeout; the backoff stays within a few seconds
+_HTTP = urllib3.PoolManager(
+    maxsize=16,
+    headers=HEADERS,
+    retries=urllib3.Retry(total=4, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                          respect_retry_after_header=False, raise_on_status=False)
+)
+
 def create_dirs():
     """Create permanent M3U directory."""
     os.makedirs(M3U_PERMANENT_DIR, exist_ok=True)
@@ -36,70 +64,96 @@ def create_dirs():
 def fetch_m3u_urls(m3u_url):
     """Fetch video URLs, titles, logos, and groups."""
     try:
-        req = urllib.request.Request(m3u_url, headers={'User-Agent': 'Mozilla/5.0'})
-        with urllib.request.urlopen(req, timeout=DOWNLOAD_TIMEOUT) as response:
-            content = response.read().decode('utf-8')
-            urls = []
-            lines = content.splitlines()
-            i = 0
-            group = SOURCE_GROUPS.get(m3u_url, "Unknown")
-            while i < len(lines):
-                if lines[i].startswith('#EXTGRP'):
-                    group = lines[i].split(':', 1)[1].strip() if ':' in lines[i] else group
-                elif lines[i].startswith('#EXTINF'):
-                    try:
-                        title = lines[i].split(',', 1)[1].strip() if ',' in lines[i] else f"Video_{len(urls)+1}"
-                        logo_match = re.search(r'tvg-logo\s*=\s*"([^"]+)"', lines[i])
-                        logo = logo_match.group(1) if logo_match else DEFAULT_LOGO
-                        english_title = unidecode(title)
-                        i += 1
-                        if i < len(lines) and lines[i].strip() and not lines[i].startswith('#'):
-                            url = lines[i].strip()
-                            # if not url.lower().endswith(('.mp4', '.mkv','.m3u8')):
-                            if not url.lower().endswith(('.mp4', '.mkv')):
-                                logging.warning(f"Skipping unsupported URL: {url}")
-                                continue
-                            urls.append((url, english_title, logo, group))
-                    except IndexError:
-                        logging.warning(f"Invalid #EXTINF at line {i+1}")
-                i += 1
-            logging.info(f"Fetched {len(urls)} URLs from {m3u_url}: {urls[:3]}...")
-            return urls
-    except urllib.error.URLError as e:
+        response = _HTTP.request('GET', m3u_url, timeout=DOWNLOAD_TIMEOUT)
+        if response.status != 200:
+            logging.error(f"Error fetching {m3u_url}: HTTP {response.status}")
+            return []
+        content = response.data.decode('utf-8')
+        entries = []
+        group = SOURCE_GROUPS.get(m3u_url, "Unknown")
+        for match in _ENTRY_RE.finditer(content):
+            group_line, extinf, url = match.groups()
+            if extinf is None:
+                _, sep, value = group_line.partition(':')
+                if sep:
+                    group = value.strip()
+            else:
+                _, sep, title = extinf.partition(',')
+                title = title.strip() if sep else f"Video_{len(entries)+1}"
+                logo_match = _LOGO_RE.search(extinf)
+                logo = logo_match.group(1) if logo_match else DEFAULT_LOGO
+                url = (url or '').strip()
+                if not url or url.startswith('#'):
+                    continue
+                if os.path.splitext(urlparse(url).path)[1].lower() not in SUPPORTED_EXTENSIONS:
+                    logging.warning(f"Skipping unsupported URL: {url}")
+                    continue
+                entries.append((url, title, logo, group))
+        # unidecode is only needed for titles with non-ASCII characters
+        english_titles = [title if title.isascii() else _transliterate(title) for _, title, _, _ in entries]
+        urls = [(url, english_title, logo, group)
+                for (url, _, logo, group), english_title in zip(entries, english_titles)]
+        logging.info(f"Fetched {len(urls)} URLs from {m3u_url}: {urls[:3]}...")
+        return urls
+    except urllib3.exceptions.HTTPError as e:
         logging.error(f"Error fetching {m3u_url}: {e}")
         return []
     except Exception as e:
         logging.error(f"Unexpected error fetching {m3u_url}: {e}")
         return []
 
+def _write_atomic(path, data):
+    """Atomically replace path with data; return False if it already holds exactly data."""
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except OSError:
+        pass
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+    return True
+
 def save_metadata(metadata):
-    """Save video metadata."""
+    """Save video metadata atomically."""
     try:
-        with open(METADATA_JSON, 'w') as f:
-            json.dump(metadata, f, indent=2)
-        logging.info(f"Saved metadata to {METADATA_JSON}")
+        if orjson:
+            data = orjson.dumps(metadata, option=orjson.OPT_INDENT_2)
+        else:
+            data = json.dumps(metadata, indent=2).encode('utf-8')
+        if _write_atomic(METADATA_JSON, data):
+            logging.info(f"Saved metadata to {METADATA_JSON}")
+        else:
+            logging.info(f"Metadata unchanged, kept {METADATA_JSON}")
     except Exception as e:
         logging.error(f"Error saving {METADATA_JSON}: {e}")
 
 def write_master_m3u(videos):
-    """Write master.m3u with raw URLs."""
+    """Write master.m3u atomically with raw URLs from any iterable of video dicts."""
     try:
-        with open(FINAL_M3U, 'w') as f:
-            f.write("#EXTM3U\n")
-            for video in videos:
-                f.write(f"#EXTINF:-1 tvg-logo=\"{video['logo']}\" group-title=\"{video['group']}\",{video['title']}\n")
-                f.write(f"{video['url']}\n")
-        logging.info(f"Wrote {len(videos)} videos to {FINAL_M3U}")
+        count = 0
+        buf = bytearray(b"#EXTM3U\n")
+        for video in videos:
+            buf += f"#EXTINF:-1 tvg-logo=\"{video['logo']}\" group-title=\"{video['group']}\",{video['title']}\n{video['url']}\n".encode('utf-8')
+            count += 1
+        if _write_atomic(FINAL_M3U, buf):
+            logging.info(f"Wrote {count} videos to {FINAL_M3U}")
+        else:
+            logging.info(f"{FINAL_M3U} unchanged ({count} videos)")
     except Exception as e:
         logging.error(f"Error writing {FINAL_M3U}: {e}")
 
 def main():
     create_dirs()
-    all_videos = []
     metadata = {}
 
-    for source_idx, source_url in enumerate(SOURCES):
-        video_urls = fetch_m3u_urls(source_url)
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(SOURCES))) as executor:
+        results = list(executor.map(fetch_m3u_urls, SOURCES))
+
+    for source_idx, video_urls in enumerate(results):
         for idx, (url, title, logo, group) in enumerate(video_urls):
             video_id = f"video_{source_idx+1}_{idx+1}"
             video_data = {
@@ -109,10 +163,9 @@ def main():
                 "group": group,
                 "source": f"source_{source_idx+1}"
             }
-            all_videos.append(video_data)
             metadata[video_id] = video_data
 
-    write_master_m3u(all_videos)
+    write_master_m3u(metadata.values())
     save_metadata(metadata)
 
 if __name__ == "__main__":
@@ -0,0 +1,6 @@
+# Production server for stream_server.py: gunicorn -c gunicorn.conf.py stream_server:app
+bind = "0.0.0.0:5000"
+worker_class = "gthread"
+# One process so the conversion slots and caches in stream_server are shared by every request
+workers = 1
+threads = 32
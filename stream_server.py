@@ -1,67 +1,418 @@
 import os
+import random
+import shutil
 import subprocess
-import urllib.request
+import tempfile
+import threading
+import heapq
 import json
 import logging
-from flask import Flask, Response, send_file
+import time
+from collections import defaultdict
+from flask import Flask, Response, send_from_directory
 from pathlib import Path
+import urllib3
 from unidecode import unidecode
-import urllib.error
+
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib decoder
+    orjson = None
 
 app = Flask(__name__)
 
 # Configuration
 OUTPUT_DIR = "hls_output"
 METADATA_JSON = "video_metadata.json"
+FFMPEG_CAPS_JSON = "ffmpeg_caps.json"
 DOWNLOAD_TIMEOUT = 15
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_CHUNK_SIZE = 4 << 20  # 4 MB
+RETRYABLE_HTTP_ERRORS = frozenset({408, 429})  # client errors that can clear up on retry
+MAX_BACKOFF = 30  # seconds
+MAX_VIDEO_BYTES = 8 * 1024 ** 3  # 8 GB
+# Besides video/*, types that hosts commonly serve video files as
+VIDEO_CONTENT_TYPES = frozenset({'application/octet-stream', 'binary/octet-stream', 'application/x-matroska'})
 MAX_CACHE_SIZE_MB = 1000  # 1 GB
+MAX_CONVERSIONS = min(os.cpu_count() or 1, 4)  # concurrent ffmpeg/packager runs
+PROBE_TIMEOUT = 30  # seconds for ffprobe and capability listings
+CONVERT_TIMEOUT = 3600  # seconds before a stuck ffmpeg/packager run is killed
+# Scratch space for fallback downloads and in-progress conversions, emptied at startup. Under
+# OUTPUT_DIR it shares the filesystem so publishing is a rename; set HLS_TMP to put it on a
+# tmpfs with room for whole videos
+SCRATCH_DIR = os.path.join(os.environ.get("HLS_TMP") or OUTPUT_DIR, ".scratch")
+HLS_SEGMENT_SECONDS = 10  # target HLS segment length
+# (height, video bitrate) rungs encoded in one NVENC pass; empty for a single rendition
+HLS_RENDITIONS = [(1080, "5M"), (720, "3M"), (480, "1M")]
+
+# Mimetype and client cache lifetime per HLS file type. Lifetimes stay short because video
+# ids are positional and folders are rebuilt under the same names; ETags make revalidation cheap
+_HLS_FILE_TYPES = {
+    ".m3u8": ("application/vnd.apple.mpegurl", 10),
+    ".ts": ("video/mp2t", 60),
+}
+
+# Fixed parts of every ffmpeg invocation
+_FFMPEG_PREFIX = ("ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y")
+_CUDA_INPUT_ARGS = ("-hwaccel", "cuda", "-hwaccel_output_format", "cuda")
+_NVENC_ARGS = ("-preset", "p4", "-tune", "ll", "-rc", "vbr", "-forced-idr", "1")
+# Hardware encoders in order of preference: (encoder, hwaccel, input args, encoder args)
+_HW_ENCODERS = (
+    ("h264_nvenc", "cuda", _CUDA_INPUT_ARGS, (*_NVENC_ARGS, "-cq", "23")),
+    ("h264_qsv", "qsv", ("-hwaccel", "qsv", "-hwaccel_output_format", "qsv"), ("-preset", "medium", "-global_quality", "23")),
+    ("h264_vaapi", "vaapi", ("-hwaccel", "vaapi", "-hwaccel_output_format", "vaapi",
+                             "-vaapi_device", "/dev/dri/renderD128"), ("-qp", "23")),
+)
+# Re-encodes force a keyframe at every segment boundary whatever the frame rate, and
+# ffmpeg only cuts on keyframes, so every segment is independently decodable
+_KEYFRAME_ARGS = ("-force_key_frames", f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})")
+_HLS_OUTPUT_ARGS = (
+    "-f", "hls", "-hls_time", str(HLS_SEGMENT_SECONDS), "-hls_list_size", "0",
+    "-hls_playlist_type", "vod", "-hls_flags", "independent_segments"
+)
 
 # Setup logging
 logging.basicConfig(filename='stream.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Shared connection pool, reused by every request thread
+HEADERS = {'User-Agent': 'Mozilla/5.0'}
+# Video bytes are never compressed in transit; skip the decoding path entirely
+DOWNLOAD_HEADERS = dict(HEADERS, **{'Accept-Encoding': 'identity'})
+# The pool only retries failed connects and reads; download_video retries error statuses
+# itself, so it can cap Retry-After at MAX_BACKOFF and resume partial files
+_HTTP = urllib3.PoolManager(
+    maxsize=16,
+    headers=HEADERS,
+    retries=urllib3.Retry(connect=2, read=2, status=0, backoff_factor=0.5,
+                          respect_retry_after_header=False, raise_on_status=False)
+)
+
+_metadata_cache = (None, {})  # (mtime_ns of METADATA_JSON, parsed metadata)
+
 def load_metadata():
-    """Load video metadata."""
+    """Load video metadata, reparsing only when the file has been replaced."""
+    global _metadata_cache
     try:
-        if os.path.exists(METADATA_JSON):
-            with open(METADATA_JSON, 'r') as f:
-                return json.load(f)
-        return {}
+        if not os.path.exists(METADATA_JSON):
+            return {}
+        mtime = os.stat(METADATA_JSON).st_mtime_ns
+        cached_mtime, cached = _metadata_cache
+        if mtime == cached_mtime:
+            return cached
+        with open(METADATA_JSON, 'rb') as f:
+            data = f.read()
+        metadata = orjson.loads(data) if orjson else json.loads(data)
+        _metadata_cache = (mtime, metadata)
+        return metadata
     except Exception as e:
         logging.error(f"Error loading {METADATA_JSON}: {e}")
         return {}
 
+def _rejection_reason(response, offset):
+    """Why a successful GET response is not a usable video, or None if it is."""
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if content_type and not content_type.startswith('video/') and content_type not in VIDEO_CONTENT_TYPES:
+        return f"Content-Type {content_type}"
+    content_length = response.headers.get('Content-Length', '')
+    if content_length.isdigit() and offset + int(content_length) > MAX_VIDEO_BYTES:
+        return f"{offset + int(content_length)} bytes exceeds MAX_VIDEO_BYTES"
+    return None
+
 def download_video(url, output_path):
-    """Download video."""
+    """Download video, resuming a partial file on retry."""
     logging.info(f"Downloading: {url}")
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        retry_after = None
+        try:
+            size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+            headers = dict(DOWNLOAD_HEADERS, Range=f"bytes={size}-") if size else DOWNLOAD_HEADERS
+            response = _HTTP.request('GET', url, headers=headers, preload_content=False,
+                                     decode_content=False, timeout=DOWNLOAD_TIMEOUT)
+            try:
+                if response.status == 416 and size:
+                    logging.info(f"Already downloaded {url} to {output_path}")
+                    return True
+                # 4xx means the URL is invalid or unreachable; 5xx and throttling are worth a retry
+                if 400 <= response.status < 500 and response.status not in RETRYABLE_HTTP_ERRORS:
+                    logging.error(f"Invalid or unreachable URL {url}: HTTP {response.status}")
+                    return False
+                if response.status not in (200, 206):
+                    retry_after = response.headers.get('Retry-After')
+                    raise urllib3.exceptions.HTTPError(f"HTTP {response.status}")
+                reason = _rejection_reason(response, size if response.status == 206 else 0)
+                if reason:
+                    logging.error(f"Rejected {url}: {reason}")
+                    return False
+                # A 200 means the server ignored Range, so start over
+                # Chunks are large, so write them straight through without a Python-side buffer
+                with open(output_path, 'ab' if response.status == 206 else 'wb', buffering=0) as f:
+                    shutil.copyfileobj(response, f, DOWNLOAD_CHUNK_SIZE)
+            finally:
+                response.release_conn()
+            logging.info(f"Downloaded {url} to {output_path}")
+            return True
+        except urllib3.exceptions.HTTPError as e:
+            logging.warning(f"Download attempt {attempt} failed for {url}: {e}")
+            if attempt < DOWNLOAD_RETRIES:
+                if retry_after and retry_after.isdigit():
+                    delay = min(int(retry_after), MAX_BACKOFF)
+                else:
+                    # Jitter keeps threads retrying the same host from waking together
+                    delay = min(MAX_BACKOFF, 0.5 * 2 ** attempt) * (0.5 + random.random())
+                time.sleep(delay)
+        except Exception as e:
+            logging.error(f"Unexpected error downloading {url}: {e}")
+            return False
+    logging.error(f"Failed to download {url}")
+    return False
+
+def _is_remote(input_file):
+    return input_file.startswith(('http://', 'https://'))
+
+def _input_args(input_file):
+    """ffmpeg input options; remote inputs reconnect on dropped connections."""
+    if _is_remote(input_file):
+        return [
+            "-user_agent", HEADERS['User-Agent'],
+            "-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "10",
+            "-i", input_file
+        ]
+    return ["-i", input_file]
+
+# Bounds encoder processes separately from request threads, so downloads keep flowing
+_conversion_slots = threading.BoundedSemaphore(MAX_CONVERSIONS)
+
+_ffmpeg_caps = None
+_ffmpeg_caps_lock = threading.Lock()
+
+def _list_ffmpeg(option):
+    """Return the names listed by `ffmpeg -hide_banner <option>`."""
+    result = subprocess.run(["ffmpeg", "-hide_banner", option], check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=PROBE_TIMEOUT)
+    lines = result.stdout.decode().splitlines()
+    if option == "-hwaccels":
+        return [line.strip() for line in lines[1:] if line.strip()]
+    # Codec listings have a legend ending in a dashed line, then "<flags> <name> <description>"
+    names = []
+    in_table = False
+    for line in lines:
+        if in_table:
+            fields = line.split()
+            if len(fields) >= 2:
+                names.append(fields[1])
+        elif line.strip().startswith("---"):
+            in_table = True
+    return names
+
+def load_ffmpeg_caps():
+    """Return ffmpeg's encoders, decoders and hwaccels, cached in FFMPEG_CAPS_JSON across runs."""
+    global _ffmpeg_caps
+    with _ffmpeg_caps_lock:
+        if _ffmpeg_caps is not None:
+            return _ffmpeg_caps
+        _ffmpeg_caps = {"encoders": [], "decoders": [], "hwaccels": []}
+        ffmpeg_path = shutil.which("ffmpeg")
+        if not ffmpeg_path:
+            logging.warning("ffmpeg not found on PATH")
+            return _ffmpeg_caps
+        ffmpeg_mtime = os.path.getmtime(ffmpeg_path)
+        try:
+            with open(FFMPEG_CAPS_JSON, 'r') as f:
+                cached = json.load(f)
+            if cached.get("ffmpeg_path") == ffmpeg_path and cached.get("ffmpeg_mtime") == ffmpeg_mtime:
+                _ffmpeg_caps = cached
+                return _ffmpeg_caps
+        except (OSError, ValueError):
+            pass
+        try:
+            caps = {
+                "ffmpeg_path": ffmpeg_path,
+                "ffmpeg_mtime": ffmpeg_mtime,
+                "encoders": _list_ffmpeg("-encoders"),
+                "decoders": _list_ffmpeg("-decoders"),
+                "hwaccels": _list_ffmpeg("-hwaccels")
+            }
+            with open(FFMPEG_CAPS_JSON, 'w') as f:
+                json.dump(caps, f)
+            _ffmpeg_caps = caps
+            logging.info(f"Probed ffmpeg: hwaccels={caps['hwaccels']}")
+        except Exception as e:
+            logging.warning(f"Could not probe ffmpeg capabilities: {e}")
+        return _ffmpeg_caps
+
+# Encoders that ffmpeg lists but that failed on this host; skipped until restart
+_failed_hw_encoders = set()
+
+def _hw_encoder():
+    """Return the first usable _HW_ENCODERS entry, or None for CPU encoding."""
+    caps = load_ffmpeg_caps()
+    for encoder in _HW_ENCODERS:
+        if encoder[0] in _failed_hw_encoders:
+            continue
+        if encoder[0] in caps["encoders"] and encoder[1] in caps["hwaccels"]:
+            return encoder
+    return None
+
+_probe_cache = {}
+
+def probe_video(input_file):
+    """Return the first video stream's codec and height and whether there is audio; remote results are cached."""
+    if input_file in _probe_cache:
+        return _probe_cache[input_file]
     try:
-        req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-        urllib.request.urlretrieve(req, output_path)
-        logging.info(f"Downloaded {url} to {output_path}")
-        return True
-    except urllib.error.URLError as e:
-        logging.error(f"Failed to download {url}: {e}")
-        return False
+        cmd = [
+            "ffprobe", "-v", "error",
+            "-show_entries", "stream=codec_type,codec_name,height",
+            "-of", "json",
+            *_input_args(input_file)
+        ]
+        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=PROBE_TIMEOUT)
+        streams = json.loads(result.stdout).get("streams", [])
+        video = next((st for st in streams if st.get("codec_type") == "video"), {})
+        probe = {
+            "codec": video.get("codec_name"),
+            "height": video.get("height"),
+            "audio": any(st.get("codec_type") == "audio" for st in streams)
+        }
+        if _is_remote(input_file):
+            _probe_cache[input_file] = probe
+        return probe
     except Exception as e:
-        logging.error(f"Unexpected error downloading {url}: {e}")
-        return False
+        logging.warning(f"ffprobe failed for {input_file}: {e}")
+        # Unknown source: re-encode, keep every rung and expect an audio track
+        return {"codec": None, "height": None, "audio": True}
 
-def convert_to_hls(input_file, output_folder, video_id):
-    """Convert to HLS."""
+def _nvenc_ladder_cmd(input_file, output_folder, output_m3u8, probe):
+    """Build one ffmpeg command that decodes once and encodes HLS_RENDITIONS rungs on the GPU."""
+    height = probe["height"]
+    # Never upscale; a source below every rung gets one rendition at its own height
+    rungs = [rung for rung in HLS_RENDITIONS if not height or rung[0] <= height]
+    rungs = rungs or [(height, HLS_RENDITIONS[-1][1])]
+    count = len(rungs)
+    splits = "".join(f"[v{i}]" for i in range(count))
+    scales = ";".join(f"[v{i}]scale_cuda=-2:{rung_height}[v{i}o]" for i, (rung_height, _) in enumerate(rungs))
+    cmd = [
+        *_FFMPEG_PREFIX, *_CUDA_INPUT_ARGS,
+        *_input_args(input_file),
+        "-filter_complex", f"[0:v]split={count}{splits};{scales}"
+    ]
+    for i, (_, bitrate) in enumerate(rungs):
+        cmd += ["-map", f"[v{i}o]", f"-c:v:{i}", "h264_nvenc", f"-b:v:{i}", bitrate]
+        if probe["audio"]:
+            cmd += ["-map", "0:a:0?", f"-c:a:{i}", "aac", f"-b:a:{i}", "128k"]
+    stream_map = " ".join(f"v:{i},a:{i}" if probe["audio"] else f"v:{i}" for i in range(count))
+    cmd += [
+        *_NVENC_ARGS, *_KEYFRAME_ARGS,
+        "-var_stream_map", stream_map,
+        *_HLS_OUTPUT_ARGS,
+        "-master_pl_name", os.path.basename(output_m3u8),
+        "-hls_segment_filename", os.path.join(output_folder, "stream_%v_%03d.ts"),
+        os.path.join(output_folder, "stream_%v.m3u8")
+    ]
+    return cmd
+
+def _ffmpeg_hls_cmd(input_file, work_folder, work_m3u8, probe, hw_encoder):
+    """Build the ffmpeg HLS command; hw_encoder is a _HW_ENCODERS entry, or None for libx264."""
+    if hw_encoder and hw_encoder[0] == "h264_nvenc" and HLS_RENDITIONS:
+        return _nvenc_ladder_cmd(input_file, work_folder, work_m3u8, probe)
+    if probe["codec"] == "h264":
+        cmd = [*_FFMPEG_PREFIX, *_input_args(input_file), "-c:v", "copy"]
+    elif hw_encoder:
+        name, _, hw_input_args, encoder_args = hw_encoder
+        cmd = [
+            *_FFMPEG_PREFIX, *hw_input_args,
+            *_input_args(input_file),
+            "-c:v", name, *encoder_args, *_KEYFRAME_ARGS
+        ]
+    else:
+        cmd = [*_FFMPEG_PREFIX, *_input_args(input_file), "-c:v", "libx264", "-b:v", "1M", *_KEYFRAME_ARGS]
+    cmd += [
+        "-c:a", "aac", "-b:a", "128k",
+        *_HLS_OUTPUT_ARGS,
+        "-hls_segment_filename", os.path.join(work_folder, "segment_%03d.ts"),
+        work_m3u8
+    ]
+    return cmd
+
+def _run_conversion(cmd):
+    """Run an encoder command in one of the conversion slots."""
+    with _conversion_slots:
+        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=CONVERT_TIMEOUT)
+
+def package_to_hls(input_file, output_folder, video_id):
+    """Segment already H.264 input with Shaka Packager, skipping ffmpeg's muxer."""
+    if not shutil.which("packager"):
+        return None
     try:
         os.makedirs(output_folder, exist_ok=True)
         output_m3u8 = os.path.join(output_folder, "playlist.m3u8")
         cmd = [
-            "ffmpeg", "-i", input_file,
-            "-c:v", "libx264", "-b:v", "1M",
-            "-c:a", "aac", "-b:a", "128k",
-            "-f", "hls",
-            "-hls_time", "4",
-            "-hls_list_size", "0",
-            "-hls_segment_filename", os.path.join(output_folder, "segment_%03d.ts"),
-            output_m3u8
+            "packager",
+            f"in={input_file},stream=video,"
+            f"segment_template={os.path.join(output_folder, 'video_$Number%03d$.ts')},"
+            f"playlist_name=video.m3u8",
+            f"in={input_file},stream=audio,"
+            f"segment_template={os.path.join(output_folder, 'audio_$Number%03d$.ts')},"
+            f"playlist_name=audio.m3u8,hls_group_id=audio,hls_name=default",
+            "--hls_master_playlist_output", output_m3u8,
+            "--segment_duration", str(HLS_SEGMENT_SECONDS)
         ]
+        logging.info(f"Packaging {input_file} for {video_id}")
+        _run_conversion(cmd)
+        logging.info(f"Packaged to HLS: {output_m3u8}")
+        return output_m3u8
+    except subprocess.CalledProcessError as e:
+        logging.warning(f"Packager failed for {video_id}, falling back to ffmpeg: {e.stderr.decode()}")
+        return None
+    except Exception as e:
+        logging.warning(f"Unexpected packager error for {video_id}: {e}")
+        return None
+
+def _publish_hls(work_folder, output_folder):
+    """Move a finished HLS folder into place so clients never see a partial playlist."""
+    staging = output_folder + ".partial"
+    shutil.rmtree(staging, ignore_errors=True)
+    shutil.move(work_folder, staging)  # one sequential copy when work_folder is on tmpfs
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.replace(staging, output_folder)
+
+def convert_to_hls(input_file, output_folder, video_id):
+    """Convert to HLS, copying H.264 video and using a hardware encoder when available."""
+    work_folder = None
+    try:
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        os.makedirs(SCRATCH_DIR, exist_ok=True)
+        # Segments are written to scratch space and published in one move
+        work_folder = tempfile.mkdtemp(prefix=f"{video_id}_", dir=SCRATCH_DIR)
+        work_m3u8 = os.path.join(work_folder, "playlist.m3u8")
+        output_m3u8 = os.path.join(output_folder, "playlist.m3u8")
+        probe = probe_video(input_file)
+        if probe["codec"] == "h264" and not _is_remote(input_file):
+            if package_to_hls(input_file, work_folder, video_id):
+                _publish_hls(work_folder, output_folder)
+                return output_m3u8
+            # Drop any partial packager output before ffmpeg takes over
+            shutil.rmtree(work_folder)
+            os.makedirs(work_folder)
+        # Only sources ffprobe could read go to the GPU, so a failed hardware run points at
+        # the encoder rather than a dead link or a dropped connection
+        hw_encoder = _hw_encoder() if probe["codec"] not in (None, "h264") else None
+        cmd = _ffmpeg_hls_cmd(input_file, work_folder, work_m3u8, probe, hw_encoder)
         logging.info(f"Converting {input_file} for {video_id}")
-        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            _run_conversion(cmd)
+        except subprocess.CalledProcessError as e:
+            if not hw_encoder:
+                raise
+            # A listed encoder can still fail at runtime, e.g. no GPU or driver on this host
+            logging.warning(f"{hw_encoder[0]} failed for {video_id}, retrying with libx264: {e.stderr.decode()}")
+            shutil.rmtree(work_folder)
+            os.makedirs(work_folder)
+            _run_conversion(_ffmpeg_hls_cmd(input_file, work_folder, work_m3u8, probe, None))
+            # The same source converts on the CPU, so the hardware path is what failed
+            _failed_hw_encoders.add(hw_encoder[0])
+            logging.warning(f"Disabled {hw_encoder[0]} until restart")
+        _publish_hls(work_folder, output_folder)
         logging.info(f"Converted to HLS: {output_m3u8}")
         return output_m3u8
     except subprocess.CalledProcessError as e:
@@ -70,31 +421,65 @@ def convert_to_hls(input_file, output_folder, video_id):
     except Exception as e:
         logging.error(f"Unexpected error converting {video_id}: {e}")
         return None
+    finally:
+        if work_folder and os.path.exists(work_folder):
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+def _dir_size(path):
+    """Total size in bytes of the files under path, using scandir's directory entries."""
+    total = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    total += _dir_size(entry.path)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_size
+            except FileNotFoundError:
+                pass  # removed by a concurrent publish or eviction
+    return total
 
 def clean_cache():
     """Delete oldest HLS folders if cache exceeds size."""
     try:
         total_size = 0
         folders = []
-        for root, dirs, files in os.walk(OUTPUT_DIR):
-            for file in files:
-                file_path = os.path.join(root, file)
-                total_size += os.path.getsize(file_path) / (1024 * 1024)  # MB
-            for dir in dirs:
-                folders.append(os.path.join(root, dir))
-        if total_size > MAX_CACHE_SIZE_MB:
-            folders.sort(key=lambda x: os.path.getmtime(x))
-            for folder in folders[:len(folders)//2]:
-                for root, dirs, files in os.walk(folder, topdown=False):
-                    for file in files:
-                        os.remove(os.path.join(root, file))
-                    for dir in dirs:
-                        os.rmdir(os.path.join(root, dir))
-                os.rmdir(folder)
+        with os.scandir(OUTPUT_DIR) as entries:
+            for entry in entries:
+                # Only published video folders are sized, since only they can be evicted;
+                # scratch, stray files and folders still being published are left out
+                if entry.path == SCRATCH_DIR or entry.name.endswith(".partial"):
+                    continue
+                try:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    total_size += _dir_size(entry.path)
+                    folders.append((entry.stat(follow_symlinks=False).st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass  # published or evicted by another thread mid-scan
+        if total_size > MAX_CACHE_SIZE_MB * 1024 * 1024:
+            for _, folder in heapq.nsmallest(len(folders) // 2, folders):
+                shutil.rmtree(folder, ignore_errors=True)
                 logging.info(f"Deleted old cache: {folder}")
     except Exception as e:
         logging.warning(f"Error cleaning cache: {e}")
 
+def reset_scratch():
+    """Remove downloads and work folders left behind by a killed worker."""
+    shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+    os.makedirs(SCRATCH_DIR, exist_ok=True)
+
+reset_scratch()
+
+# Per-video locks so concurrent requests don't convert the same video twice
+_video_locks = defaultdict(threading.Lock)
+
+def _send_hls(directory, filename):
+    """Send an HLS file with conditional requests, an ETag and cache headers."""
+    mimetype, max_age = _HLS_FILE_TYPES.get(os.path.splitext(filename)[1], (None, 0))
+    return send_from_directory(directory, filename, mimetype=mimetype,
+                               conditional=True, etag=True, max_age=max_age)
+
 @app.route('/stream/<video_id>')
 def stream(video_id):
     """Stream HLS for video_id."""
@@ -109,29 +494,44 @@ def stream(video_id):
 
     if os.path.exists(m3u8_file):
         logging.info(f"Serving cached HLS: {video_id}")
-        return send_file(m3u8_file)
+        return _send_hls(output_folder, "playlist.m3u8")
 
-    temp_file = f"temp_{video_id}_{int(time.time())}.mp4"
-    try:
-        if download_video(url, temp_file):
-            m3u8_file = convert_to_hls(temp_file, output_folder, video_id)
-            if m3u8_file:
-                clean_cache()
-                logging.info(f"Streaming new HLS: {video_id}")
-                return send_file(m3u8_file)
-        return "Failed to process video", 500
-    finally:
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
-            logging.info(f"Cleaned temp file: {temp_file}")
+    # Only the first request for a video converts it; the others wait and reuse its output
+    with _video_locks[video_id]:
+        if os.path.exists(m3u8_file):
+            logging.info(f"Serving HLS converted by another request: {video_id}")
+            return _send_hls(output_folder, "playlist.m3u8")
+        # Let ffmpeg read the URL itself so decoding overlaps the download
+        m3u8_file = convert_to_hls(url, output_folder, video_id)
+        if not m3u8_file:
+            logging.warning(f"Direct conversion failed for {video_id}, downloading first")
+            # mkstemp gives each request its own file even for the same video in the same second
+            fd, temp_file = tempfile.mkstemp(prefix=f"temp_{video_id}_", suffix=".mp4", dir=SCRATCH_DIR)
+            os.close(fd)
+            try:
+                if download_video(url, temp_file):
+                    m3u8_file = convert_to_hls(temp_file, output_folder, video_id)
+            finally:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                    logging.info(f"Cleaned temp file: {temp_file}")
+    if m3u8_file:
+        clean_cache()
+        logging.info(f"Streaming new HLS: {video_id}")
+        return _send_hls(output_folder, "playlist.m3u8")
+    return "Failed to process video", 500
 
 @app.route('/stream/<video_id>/<path:segment>')
 def serve_segment(video_id, segment):
     """Serve HLS segments."""
+    # Only known ids map to folders; send_from_directory keeps segment inside that folder
+    if video_id not in load_metadata():
+        return "Segment not found", 404
     segment_path = os.path.join(OUTPUT_DIR, video_id, segment)
-    if os.path.exists(segment_path):
-        return send_file(segment_path)
+    if os.path.isfile(segment_path):
+        return _send_hls(os.path.join(OUTPUT_DIR, video_id), segment)
     return "Segment not found", 404
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000)
+    # Development only; production runs under gunicorn with gunicorn.conf.py
+    app.run(host='0.0.0.0', port=5000, threaded=True)